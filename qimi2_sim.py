@@ -1,114 +1,38 @@
-import argparse, multiprocessing as mp, os, sys, time, signal, tempfile, math
-
-PAGE_SIZE = 4096
-
-def parse_size(s: str) -> int:
-    s = s.strip().lower()
-    units = {'k':1024,'ki':1024,'m':1024**2,'mi':1024**2,'g':1024**3,'gi':1024**3,'t':1024**4,'ti':1024**4}
-    for u, mul in sorted(units.items(), key=lambda x: -len(x[0])):
-        if s.endswith(u): return int(float(s[:-len(u)]) * mul)
-    return int(s)
-
-def human(n: int | None) -> str:
-    if n is None: return "n/a"
-    f = float(n)
-    for u in ["B","KiB","MiB","GiB","TiB"]:
-        if f < 1024 or u == "TiB": return f"{f:.2f} {u}"
-        f /= 1024
-
-class DualLogger:
-    def __init__(self, path: str):
-        self.f = open(path, "a", buffering=1, encoding="utf-8")
-        self.log(f"=== start pid={os.getpid()} at {time.strftime('%F %T')} ===")
-    def log(self, msg: str):
-        line = f"{time.strftime('%F %T')} | {msg}\n"
-        try:
-            sys.stdout.write(line); sys.stdout.flush()
-            self.f.write(line); self.f.flush(); os.fsync(self.f.fileno())
-        except Exception: pass
-    def close(self):
-        try: self.log("=== graceful stop ==="); self.f.close()
-        except Exception: pass
-
-def read_cgroup_limits():
-    mem_limit=None; cpu_quota=None; cpu_period=None
-    try:
-        with open("/sys/fs/cgroup/memory.max") as f:
-            v=f.read().strip(); mem_limit=None if v=="max" else int(v)
-    except Exception: pass
-    if mem_limit is None:
-        for p in ("/sys/fs/cgroup/memory/memory.limit_in_bytes","/sys/fs/cgroup/memory.limit_in_bytes"):
-            try:
-                with open(p) as f: mem_limit=int(f.read().strip()); break
-            except Exception: pass
-    try:
-        with open("/sys/fs/cgroup/cpu.max") as f:
-            a=f.read().strip().split()
-            if len(a)==2 and a[0]!="max": cpu_quota=int(a[0]); cpu_period=int(a[1])
-    except Exception: pass
-    if cpu_quota is None or cpu_period is None:
-        try:
-            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f1: q=int(f1.read().strip())
-            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f2: p=int(f2.read().strip())
-            if q>0: cpu_quota, cpu_period = q, p
-        except Exception: pass
-    return mem_limit, cpu_quota, cpu_period
-
-def read_mem_current():
-    try:
-        with open("/sys/fs/cgroup/memory.current") as f: return int(f.read().strip())
-    except Exception: pass
-    for p in ("/sys/fs/cgroup/memory/memory.usage_in_bytes","/sys/fs/cgroup/memory.usage_in_bytes"):
-        try:
-            with open(p) as f: return int(f.read().strip())
-        except Exception: pass
-    return None
-
-def read_mem_peak():
-    try:
-        with open("/sys/fs/cgroup/memory.peak") as f: return int(f.read().strip())
-    except Exception: pass
-    for p in ("/sys/fs/cgroup/memory/memory.max_usage_in_bytes","/sys/fs/cgroup/memory.max_usage_in_bytes"):
-        try:
-            with open(p) as f: return int(f.read().strip())
-        except Exception: pass
-    return None
-
-def read_cpu_stat_v2():
-    d={}
-    try:
-        with open("/sys/fs/cgroup/cpu.stat") as f:
-            for line in f:
-                k,v=line.strip().split()
-                d[k]=int(v)
-    except Exception:
-        pass
-    return d
-
-def touch_pages(buf: bytearray):
-    for off in range(0, len(buf), PAGE_SIZE): buf[off]=1
-
-def mem_burst(logger: DualLogger, want_bytes: int, block_bytes: int, headroom_bytes: int):
-    blocks=[]; allocated=0
-    lim,_,_ = read_cgroup_limits()
+import argparse, multiprocessing as mp, os, sys, time, signal, tempfile, mmap, errno
+try:
+    import liburing  # optional: --io-mode uring, 2024.x bindings (2026.x renamed the API to Ring/Cqe/Iovec)
+    if not hasattr(liburing, "io_uring"): liburing = None
+except ImportError:
+    liburing = None
+from stress_core import (PAGE_SIZE, DEBUG, INFO, DualLogger, MemArena, burn, fork_worker, get_logger, human, njit,
+                         parse_size, pin_order, read_cgroup_limits, read_cpu_stat_v2, read_mem_current, read_mem_peak,
+                         reap_workers)
+
+CPU_SPIN_ITERS = 10_000_000 if njit else 65536  # iterations between clock reads
+IO_CHUNK = 8*1024*1024
+IO_IOV = 8  # chunks per pwritev call
+IO_URING_DEPTH = 64
+
+def mem_burst(logger: DualLogger, want_bytes: int, block_bytes: int, headroom_bytes: int, lim: int | None, hugepages: bool = False):
+    arena=None; allocated=0
     logger.log(f"[mem] burst target={human(want_bytes)} block={human(block_bytes)} headroom={human(headroom_bytes)} limit={human(lim)}")
     try:
+        arena = MemArena(want_bytes, hugepages)
+        cur = read_mem_current()  # re-read after every block below
         while allocated < want_bytes:
-            cur = read_mem_current()
             if lim is not None and cur is not None and cur >= max(0, lim - headroom_bytes):
                 logger.log(f"[mem] stop before headroom: cur={human(cur)} / limit={human(lim)}")
                 break
             remain = want_bytes - allocated
             bsz = min(block_bytes, remain)
-            logger.log(f"[mem] plan +{human(bsz)} (now={human(allocated)})")
-            blk = bytearray(bsz); touch_pages(blk)
-            blocks.append(blk); allocated += bsz
+            logger.log_lazy("[mem] plan +{0!h} (now={1!h})", bsz, allocated)
+            allocated += arena.commit(bsz)
             cur = read_mem_current(); peak=read_mem_peak()
             ratio = f"{(cur/lim*100):.1f}%" if (cur and lim) else "n/a"
             logger.log(f"[mem] allocated={human(allocated)} cur={human(cur)} peak={human(peak)} of limit {human(lim)} ({ratio})")
-    except MemoryError:
-        logger.log(f"[mem] MemoryError at {human(allocated)} / {human(want_bytes)}")
-    return blocks
+    except (MemoryError, OSError) as e:
+        logger.log(f"[mem] {type(e).__name__} at {human(allocated)} / {human(want_bytes)}: {e}")
+    return arena
 
 def cpu_worker(stop_at: float, pin_cpu):
     try:
@@ -116,42 +40,89 @@ def cpu_worker(stop_at: float, pin_cpu):
             os.sched_setaffinity(0, {pin_cpu})
     except Exception: pass
     x=0.0
-    while time.time()<stop_at:
-        x=(x+1.0000001)*1.0000002
-        if x>1e12: x%=123456.789
+    while True:
+        x=burn(CPU_SPIN_ITERS, x)
+        if time.monotonic()>=stop_at: return
 
 def cpu_burst(logger: DualLogger, nproc: int, duration_s: int, no_affinity: bool):
-    stop_at = time.time()+max(1,duration_s)
+    stop_at = time.monotonic()+max(1,duration_s)
     try:
-        avail = sorted(os.sched_getaffinity(0))
+        avail = pin_order(sorted(os.sched_getaffinity(0)))
     except Exception:
         avail=None
-    procs=[]
-    for i in range(nproc):
-        pin=None
-        if not no_affinity and avail: pin = avail[i % len(avail)]
-        p=mp.Process(target=cpu_worker, args=(stop_at, pin))
-        p.daemon=True
-        p.start(); procs.append(p)
-        logger.log(f"[cpu] started worker {i+1}/{nproc} pin={pin}")
-    for p in procs: p.join()
-
-def io_burst(logger: DualLogger, size_bytes: int, dir_path: str):
+    burn(1, 0.0)  # JIT-compile once here, not in every forked worker
+    pids=[]; done=False
+    try:
+        for i in range(nproc):
+            pin=None
+            if not no_affinity and avail: pin = avail[i % len(avail)]
+            pids.append(fork_worker(cpu_worker, stop_at, pin))
+            logger.log(f"[cpu] started worker {i+1}/{nproc} pin={pin}")
+        reap_workers(pids); done=True
+    finally:
+        if not done: reap_workers(pids, kill=True)
+
+def uring_write(fd: int, mv: memoryview, size_bytes: int):
+    # keep up to IO_URING_DEPTH chunk writes in flight, refill as completions arrive
+    ring = liburing.io_uring(); cqes = liburing.io_uring_cqe()
+    liburing.io_uring_queue_init(IO_URING_DEPTH, ring, 0)
+    try:
+        full = liburing.iovec(mv); tail = None
+        off = 0; inflight = {}  # offset -> bytes submitted, offset travels as user_data
+        while off < size_bytes or inflight:
+            while off < size_bytes and len(inflight) < IO_URING_DEPTH:
+                n = min(IO_CHUNK, size_bytes - off)
+                if n < IO_CHUNK: tail = liburing.iovec(mv[:n])
+                sqe = liburing.io_uring_get_sqe(ring)
+                liburing.io_uring_prep_writev(sqe, fd, full if n == IO_CHUNK else tail, 1, off)
+                liburing.io_uring_sqe_set_data64(sqe, off)
+                inflight[off] = n; off += n
+            liburing.io_uring_submit(ring)
+            liburing.io_uring_wait_cqe(ring, cqes)
+            cqe = cqes[0]
+            res, at = cqe.res, cqe.user_data
+            liburing.io_uring_cqe_seen(ring, cqe)
+            liburing.trap_error(res)
+            n = inflight.pop(at)
+            if res != n: raise OSError(errno.EIO, f"short write at {at}: {res} of {n} bytes")
+    finally:
+        liburing.io_uring_queue_exit(ring)
+
+def io_burst(size_bytes: int, dir_path: str, mode: str = "write", o_direct: bool = False):
+    logger = get_logger()
     if size_bytes <= 0: 
         logger.log("[io] skipped")
         return
     os.makedirs(dir_path, exist_ok=True)
     fd, path = tempfile.mkstemp(prefix="qimi2_", suffix=".bin", dir=dir_path)
-    logger.log(f"[io] writing {human(size_bytes)} to {path}")
+    if o_direct: size_bytes = -(-size_bytes // PAGE_SIZE) * PAGE_SIZE
+    if mode == "uring" and liburing is None:
+        logger.log("[io] liburing 2024.x is not installed, falling back to write"); mode = "write"
+    logger.log(f"[io] {mode}{' O_DIRECT' if o_direct else ''} {human(size_bytes)} to {path}")
     try:
+        if o_direct:
+            os.close(fd)
+            try: fd = os.open(path, os.O_WRONLY|os.O_TRUNC|os.O_DIRECT)
+            except OSError as e:  # e.g. tmpfs
+                logger.log(f"[io] O_DIRECT unavailable ({e}), falling back to page cache")
+                o_direct = False; fd = os.open(path, os.O_WRONLY|os.O_TRUNC)
         with os.fdopen(fd, "wb", buffering=0) as f:
-            chunk = bytes(1024*1024)  # 1MiB zeros
-            left = size_bytes
-            while left > 0:
-                n = min(left, len(chunk))
-                f.write(chunk[:n])
-                left -= n
-            f.flush(); os.fsync(f.fileno())
+            # page-aligned zeros (O_DIRECT requirement); slicing a memoryview does not copy
+            mv = memoryview(mmap.mmap(-1, IO_CHUNK))
+            if mode == "fallocate":
+                # extents without pushing zeros through write(2)
+                os.posix_fallocate(f.fileno(), 0, size_bytes)
+            elif mode == "uring":
+                uring_write(f.fileno(), mv, size_bytes)
+            else:
+                left = size_bytes
+                while left > 0:
+                    if mode == "pwritev":
+                        k = min(IO_IOV, left // IO_CHUNK)
+                        left -= os.pwritev(f.fileno(), [mv]*k if k else [mv[:left]], size_bytes - left)
+                    else:
+                        left -= f.write(mv[:min(left, IO_CHUNK)])
+            if not o_direct: f.flush(); os.fsync(f.fileno())
         logger.log("[io] done")
     except Exception as e:
         logger.log(f"[io] error: {e}")
@@ -166,17 +137,25 @@ def main():
     ap.add_argument("--mem-burst", default="2Gi", help="Сколько памяти быстро занять (по умолчанию 2Gi)")
     ap.add_argument("--mem-block", default="128Mi", help="Размер одного блока аллокации (по умолчанию 128Mi)")
     ap.add_argument("--headroom", default="256Mi", help="Не заходить ближе чем на headroom к лимиту")
+    ap.add_argument("--hugepages", action="store_true", help="Выделять блоки на 2MiB hugepages (hugetlb, иначе THP)")
     ap.add_argument("--cpus", type=int, default=2, help="Сколько CPU-воркеров (по умолчанию 2)")
     ap.add_argument("--duration", type=int, default=30, help="Общая длительность CPU-фазы в секундах (по умолчанию 30)")
     ap.add_argument("--io-size", default="128Mi", help="Сколько записать во временный файл (0 чтобы выключить)")
     ap.add_argument("--io-dir", default="/tmp", help="Куда писать временный файл")
+    ap.add_argument("--io-mode", choices=("write","fallocate","pwritev","uring"), default="write",
+                    help="write — поблочно нулями, fallocate — без копирования, pwritev — по IO_IOV блоков за вызов, "
+                         "uring — io_uring с очередью IO_URING_DEPTH (нужен пакет liburing==2024.5.3)")
+    ap.add_argument("--o-direct", action="store_true", help="Писать мимо page cache (O_DIRECT), размер округляется до 4KiB")
     ap.add_argument("--no-affinity", action="store_true", help="Не пиновать воркеры к ядрам")
     ap.add_argument("--logfile", default="./qimi2_sim.log", help="Файл логов (на PVC)")
+    ap.add_argument("--log-level", choices=("debug","info"), default="info", help="debug — ещё и план каждого блока")
+    ap.add_argument("--sync-log-ms", type=int, default=0, help="fsync лога раз в N мс из фонового потока (0 — только при остановке)")
     args=ap.parse_args()
 
-    logger=DualLogger(args.logfile)
+    if "fork" in mp.get_all_start_methods(): mp.set_start_method("fork", force=True)
+    logger=get_logger(args.logfile, args.sync_log_ms, DEBUG if args.log_level == "debug" else INFO)
     def on_term(sig, frm):
-        logger.log(f"[main] signal {sig}, exit"); logger.close(); sys.exit(0)
+        logger.log(f"[main] signal {sig}, exit", direct=True); sys.exit(0)  # atexit closes the logger
     for sig in (signal.SIGINT, signal.SIGTERM): signal.signal(sig, on_term)
 
     mem_limit, cpu_quota, cpu_period = read_cgroup_limits()
@@ -188,15 +167,17 @@ def main():
 
     cpu0 = read_cpu_stat_v2()
 
-    blocks = mem_burst(
+    arena = mem_burst(
         logger,
         want_bytes=parse_size(args.mem_burst),
         block_bytes=parse_size(args.mem_block),
         headroom_bytes=parse_size(args.headroom),
+        lim=mem_limit,
+        hugepages=args.hugepages,
     )
 
     io_size = parse_size(args.io_size)
-    io_proc = mp.Process(target=io_burst, args=(logger, io_size, args.io_dir))
+    io_proc = mp.Process(target=io_burst, args=(io_size, args.io_dir, args.io_mode, args.o_direct))
     io_proc.daemon=True
     io_proc.start()
 
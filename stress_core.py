@@ -0,0 +1,413 @@
+"""Code shared by stress.py and qimi2_sim.py: sizes, logging, cgroup stats, memory arena, worker processes."""
+import atexit
+import collections
+import ctypes
+import errno
+import functools
+import itertools
+import mmap
+import multiprocessing as mp
+import os
+import queue
+import re
+import signal
+import string
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from numba import njit  # optional: compiled burn() kernel
+except ImportError:
+    njit = None
+
+PAGE_SIZE = 4096
+DEBUG, INFO = 10, 20  # DualLogger levels
+MADV_POPULATE_WRITE = getattr(mmap, "MADV_POPULATE_WRITE", 23)
+TOUCH_SHARD_MIN = 16*1024*1024
+TOUCH_TICK = 0.1  # --mem-touch-rate pacing step, seconds
+LOG_BATCH_MAX = 256  # lines per writev, below IOV_MAX
+LOG_FLUSH_SEC = 0.1
+HUGE_PAGE_SIZE = 2*1024*1024
+MAP_HUGETLB = 0x40000
+MAP_HUGE_2MB = 21 << 26
+MAP_NORESERVE = getattr(mmap, "MAP_NORESERVE", 0x4000)
+
+_libc = ctypes.CDLL(None, use_errno=True)
+
+_SZ_RE = re.compile(r'(.*?)([kmgt]i?)?', re.I | re.S)  # number, optional unit suffix
+_MULT = {'k': 1024, 'ki': 1024, 'm': 1024**2, 'mi': 1024**2, 'g': 1024**3, 'gi': 1024**3, 't': 1024**4, 'ti': 1024**4}
+
+def parse_size(s: str) -> int:
+    # same grammar as float()/int(): "1.5Gi", "+5", "1_000"; a bare number must be an integer
+    num, unit = _SZ_RE.fullmatch(s.strip()).groups()
+    return int(float(num) * _MULT[unit.lower()]) if unit else int(num)
+
+def human(n: int | None) -> str:
+    if n is None:
+        return "n/a"
+    n = float(n)
+    for unit in ["B","KiB","MiB","GiB","TiB"]:
+        if n < 1024 or unit == "TiB":
+            return f"{n:.2f} {unit}"
+        n /= 1024
+
+class HumanFormatter(string.Formatter):
+    # log_lazy conversions: {!h} -> human(), {!p} -> "12.3%"; None renders as n/a
+
+    def convert_field(self, value, conversion):
+        if conversion == "h":
+            return "n/a" if value is None else human(value)
+        if conversion == "p":
+            return "n/a" if value is None else f"{value:.1f}%"
+        return super().convert_field(value, conversion)
+
+_fmt = HumanFormatter()
+
+def log_writer(q, path: str, sync_ms: int, parent: int):
+    # off the hot path: echoes queued lines to stdout in batches and fsyncs the log file;
+    # the lines themselves are already in the file, see DualLogger.log
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # keep draining through Ctrl-C, the parent sends None
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+    sync_s = sync_ms / 1000.0
+    next_sync = time.monotonic() + sync_s
+    done = False
+    # we hold the queue's write end too, so a killed parent never shows up as EOF
+    while not done and os.getppid() == parent:
+        try:
+            lines = [q.get(timeout=LOG_FLUSH_SEC)]
+        except queue.Empty:
+            lines = []
+        while lines and len(lines) < LOG_BATCH_MAX:
+            try:
+                lines.append(q.get_nowait())
+            except queue.Empty:
+                break
+        if None in lines:
+            done = True
+            lines = [l for l in lines if l is not None]
+        if lines:
+            try:
+                os.writev(sys.stdout.fileno(), lines)
+            except OSError:
+                pass
+        if sync_s > 0 and time.monotonic() >= next_sync:
+            try:
+                os.fsync(fd)
+            except OSError:
+                pass
+            next_sync += sync_s
+    os.close(fd)
+
+class DualLogger:
+    # each line is written to the O_APPEND log fd by the caller, so it survives a SIGKILL / OOM kill
+    # right after; stdout echo and fsync go through the queue to log_writer
+    def __init__(self, path: str, sync_ms: int = 0, level: int = INFO):
+        self.path = path
+        self.level = level
+        self.owner = os.getpid()
+        self.closed = False
+        self.direct = False  # set in bare-forked workers, see fork_worker
+        self.ts = None; self.ts_str = ""
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        self.q = mp.Queue()
+        self.writer = mp.Process(target=log_writer, args=(self.q, path, sync_ms, self.owner), daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+        self.log(f"=== start pid={os.getpid()} at {time.strftime('%F %T')} ===")
+
+    def _stamp(self) -> str:
+        now = int(time.time())
+        if now != self.ts:
+            self.ts, self.ts_str = now, time.strftime('%F %T', time.localtime(now))
+        return self.ts_str
+
+    def log(self, msg: str, direct: bool = False):
+        # direct: echo with a plain write instead of the queue; for signal handlers,
+        # where Queue.put may re-enter a lock the interrupted code already holds
+        line = f"{self._stamp()} | {msg}\n".encode()
+        try:
+            os.write(self.fd, line)
+        except OSError:
+            pass
+        try:
+            if direct or self.direct:
+                os.write(sys.stdout.fileno(), line)
+            else:
+                self.q.put(line)
+        except Exception:
+            pass
+
+    def log_lazy(self, fmt: str, *args, level: int = DEBUG):
+        # args are only formatted (human() etc.) when the line passes the level filter; string.Formatter
+        # is several times slower than an f-string, so lines that are always on should use log()
+        if level >= self.level:
+            self.log(_fmt.format(fmt, *args))
+
+    def close(self):
+        if self.closed or os.getpid() != self.owner:
+            return
+        self.closed = True
+        self.log("=== graceful stop ===")
+        try:
+            self.q.put(None)
+            self.writer.join(timeout=5.0)
+        except Exception:
+            pass
+        try:
+            os.fsync(self.fd)
+        except OSError:
+            pass
+
+_logger = None
+
+def get_logger(path: str | None = None, sync_ms: int = 0, level: int = INFO) -> DualLogger:
+    # module-level singleton: forked children inherit it instead of getting it pickled through args
+    global _logger
+    if _logger is None:
+        _logger = DualLogger(path, sync_ms, level)
+    return _logger
+
+@functools.lru_cache(maxsize=1)  # limits are fixed for the container's lifetime
+def read_cgroup_limits():
+    mem_limit = None; cpu_quota = None; cpu_period = None
+    try:
+        with open("/sys/fs/cgroup/memory.max","r") as f:
+            v = f.read().strip(); mem_limit = None if v == "max" else int(v)
+    except Exception: pass
+    if mem_limit is None:
+        for p in ("/sys/fs/cgroup/memory/memory.limit_in_bytes","/sys/fs/cgroup/memory.limit_in_bytes"):
+            try:
+                with open(p,"r") as f: mem_limit = int(f.read().strip()); break
+            except Exception: pass
+    try:
+        with open("/sys/fs/cgroup/cpu.max","r") as f:
+            parts = f.read().strip().split()
+            if len(parts)==2 and parts[0]!="max": cpu_quota=int(parts[0]); cpu_period=int(parts[1])
+    except Exception: pass
+    if cpu_quota is None or cpu_period is None:
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us","r") as f1: q = int(f1.read().strip())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us","r") as f2: p = int(f2.read().strip())
+            if q > 0: cpu_quota, cpu_period = q, p
+        except Exception: pass
+    return mem_limit, cpu_quota, cpu_period
+
+class CGroupStats:
+    """Keeps cgroup stat files open and re-reads them with pread at offset 0."""
+
+    def __init__(self):
+        self.fds = {}
+        atexit.register(self.close)
+
+    def read(self, *paths) -> str | None:
+        for p in paths:
+            if p not in self.fds:
+                try: self.fds[p] = os.open(p, os.O_RDONLY|os.O_CLOEXEC)
+                except OSError: self.fds[p] = None
+            fd = self.fds[p]
+            if fd is None: continue
+            try: return os.pread(fd, 4096, 0).decode()
+            except OSError: pass
+        return None
+
+    def read_int(self, *paths) -> int | None:
+        for p in paths:
+            try: return int(self.read(p))
+            except (TypeError, ValueError): pass
+        return None
+
+    def close(self):
+        for fd in self.fds.values():
+            if fd is not None: os.close(fd)
+        self.fds.clear()
+
+_cgstats = CGroupStats()
+
+def read_mem_current():
+    return _cgstats.read_int("/sys/fs/cgroup/memory.current", "/sys/fs/cgroup/memory/memory.usage_in_bytes", "/sys/fs/cgroup/memory.usage_in_bytes")
+
+def read_mem_peak():
+    return _cgstats.read_int("/sys/fs/cgroup/memory.peak", "/sys/fs/cgroup/memory/memory.max_usage_in_bytes", "/sys/fs/cgroup/memory.max_usage_in_bytes")
+
+def read_mem_events_v2():
+    d={}
+    for fname in ("memory.events.local","memory.events"):
+        text = _cgstats.read(f"/sys/fs/cgroup/{fname}")
+        if text is None: continue
+        for line in text.splitlines():
+            k, v = line.split(); d[k]=int(v)
+        break
+    return d
+
+def read_cpu_stat_v2():
+    d={}
+    try:
+        for line in _cgstats.read("/sys/fs/cgroup/cpu.stat").splitlines():
+            k, v = line.split(); d[k]=int(v)
+    except Exception: pass
+    return d
+
+def read_self_rss():
+    try:
+        with open("/proc/self/status","r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    kb = int(line.split()[1]); return kb*1024
+    except Exception: pass
+    return None
+
+def reserve(size: int, hugepages: bool = False) -> mmap.mmap:
+    flags = mmap.MAP_PRIVATE|mmap.MAP_ANONYMOUS; prot = mmap.PROT_READ|mmap.PROT_WRITE
+    if hugepages:
+        # hugetlb reserves from the pool at mmap time, so no MAP_NORESERVE here
+        try: return mmap.mmap(-1, size, flags=flags|MAP_HUGETLB|MAP_HUGE_2MB, prot=prot)
+        except OSError: pass
+    buf = mmap.mmap(-1, size, flags=flags|MAP_NORESERVE, prot=prot)
+    if hugepages:
+        # no reserved hugetlb pool: fall back to transparent hugepages
+        try: buf.madvise(mmap.MADV_HUGEPAGE)
+        except OSError: pass
+    return buf
+
+def _populate(addr: int, size: int):
+    # ctypes releases the GIL around the call, so shards fault in concurrently
+    if _libc.madvise(ctypes.c_void_p(addr), ctypes.c_size_t(size), MADV_POPULATE_WRITE) == 0: return
+    err = ctypes.get_errno()
+    if err not in (errno.EINVAL, errno.EOPNOTSUPP): raise OSError(err, os.strerror(err))
+    ctypes.memset(addr, 1, size)  # kernel < 5.14: no MADV_POPULATE_WRITE
+
+def touch_range(addr: int, size: int):
+    nthreads = max(1, min(os.cpu_count() or 1, size // TOUCH_SHARD_MIN))
+    if nthreads == 1: return _populate(addr, size)
+    step = -(-size // nthreads // HUGE_PAGE_SIZE) * HUGE_PAGE_SIZE
+    with ThreadPoolExecutor(nthreads) as ex:
+        futs = [ex.submit(_populate, addr+off, min(step, size-off)) for off in range(0, size, step)]
+    for f in futs: f.result()
+
+def _address(mm: mmap.mmap) -> int:
+    c = ctypes.c_char.from_buffer(mm); addr = ctypes.addressof(c); del c
+    return addr
+
+class MemArena:
+    """One address-space reservation for the whole burst; blocks are committed from it in order.
+
+    If the whole size cannot be reserved up front (ulimit -v, vm.overcommit_memory=2 ignoring
+    MAP_NORESERVE), each block gets its own mapping instead, so the burst still gets as far as it can.
+    """
+
+    def __init__(self, size: int, hugepages: bool = False):
+        self.align = HUGE_PAGE_SIZE if hugepages else PAGE_SIZE
+        self.hugepages = hugepages
+        self.size = -(-size // self.align) * self.align
+        self.mm = None; self.maps = []
+        if self.size:
+            try:
+                self.mm = reserve(self.size, hugepages)
+                self.base = _address(self.mm)
+            except OSError:
+                pass
+        self.blocks = []; self.used = 0; self.committed = 0
+        self.pending = collections.deque()
+
+    def commit(self, size: int, lazy: bool = False) -> int:
+        size = min(-(-size // self.align) * self.align, self.size - self.used)
+        if self.mm is not None:
+            addr = self.base + self.used
+        else:
+            mm = reserve(size, self.hugepages)
+            self.maps.append(mm); addr = _address(mm)
+        if lazy:
+            self.pending.append([addr, size, 0])  # [addr, size, touched]; see start_toucher
+        else:
+            touch_range(addr, size)
+            self.committed += size
+        self.blocks.append((addr, size)); self.used += size
+        return size
+
+    def start_toucher(self, logger: DualLogger, rate_bps: int, guard):
+        threading.Thread(target=self._touch_loop, args=(logger, rate_bps, guard), daemon=True).start()
+
+    def _touch_loop(self, logger: DualLogger, rate_bps: int, guard):
+        # commits lazily reserved blocks at rate_bps; guard() returning False stops it (headroom)
+        budget = 0; last = time.monotonic(); was_busy = False
+        while True:
+            time.sleep(TOUCH_TICK)
+            now = time.monotonic()
+            if not self.pending:
+                if was_busy:
+                    logger.log(f"[mem] touch caught up: committed={human(self.committed)} of {human(self.used)}")
+                budget = 0; last = now; was_busy = False
+                continue
+            was_busy = True
+            budget += int(rate_bps * (now - last)); last = now
+            if not guard():
+                logger.log(f"[mem] touch stopped before headroom breach: committed={human(self.committed)} of {human(self.used)}")
+                return
+            while self.pending and budget >= self.align:
+                blk = self.pending[0]
+                n = min(blk[1] - blk[2], budget // self.align * self.align)
+                try:
+                    touch_range(blk[0] + blk[2], n)
+                except OSError as e:
+                    logger.log(f"[mem] touch failed at committed={human(self.committed)}: {e}")
+                    return
+                blk[2] += n; budget -= n; self.committed += n
+                if blk[2] == blk[1]:
+                    self.pending.popleft()
+
+def burn(n: int, x: float) -> float:
+    for _ in range(n):
+        x = (x + 1.0000001) * 1.0000002
+        if x > 1e12: x = x % 123456.789
+    return x
+
+if njit is not None:
+    burn = njit(fastmath=True)(burn)  # no cache=True: it needs a writable cache dir at import; burn(1, 0.0) compiles before forking
+
+def pin_order(available: list[int]) -> list[int]:
+    # one logical CPU per physical core, round-robin across packages; HT siblings go last
+    topo = {}
+    try:
+        for c in available:
+            base = f"/sys/devices/system/cpu/cpu{c}/topology/"
+            with open(base + "physical_package_id", "r") as f1, open(base + "core_id", "r") as f2:
+                topo[c] = (int(f1.read()), int(f2.read()))
+    except Exception:
+        return available
+    seen = set(); by_pkg = {}; siblings = []
+    for c in available:
+        if topo[c] in seen:
+            siblings.append(c)
+        else:
+            seen.add(topo[c]); by_pkg.setdefault(topo[c][0], []).append(c)
+    spread = [c for grp in itertools.zip_longest(*by_pkg.values()) for c in grp if c is not None]
+    return spread + siblings
+
+def fork_worker(target, *args) -> int:
+    # bare fork: no re-import, pipes or sentinels per worker as with mp.Process. The parent already
+    # runs the mp.Queue feeder thread and register_after_fork hooks only run for mp.Process children,
+    # so a put() here would sit in a buffer nobody flushes: the child's logger writes stdout directly
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            if _logger is not None:
+                _logger.direct = True
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(sig, signal.SIG_DFL)
+            target(*args)
+        except BaseException:
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+def reap_workers(pids: list[int], kill: bool = False):
+    for pid in pids:
+        try:
+            if kill:
+                os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except OSError:
+            pass